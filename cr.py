@@ -215,6 +215,7 @@ def filesink(fd, close=False, quiet=False):
 @coroutine
 def trickle(nxt):
     '''Coroutine. Consume sequences. Send single elements to coroutine nxt.'''
+    seq, i = (), -1
     try:
         while True:
             seq = yield
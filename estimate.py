@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+
+# stdlib
+import io
+import math
+import time
+import collections
+# local
+import cr
+
+
+'''Estimate how well a file will compress without compressing all of it.
+
+A handful of windows are read at evenly strided offsets through the file and
+compressed by every engine. Together they are about 1/BUDGET of the file,
+within MINSAMPLE and MAXSAMPLE bytes. The per-window results are extrapolated
+to the size of the whole file.
+
+- The ratio is compressed size over original size (smaller is better).
+- The bound is a half-width on the ratio: ~95% of the spread between windows,
+  plus the context gain described below. It is zero when the windows cover
+  the whole file.
+- The time is the sampled throughput scaled up to the whole file.
+
+A window is less than any engine would see of the whole file, so every ratio
+errs high. That error is measured as the context gain, on a couple of windows:
+
+- The lz engine keeps one dictionary across all the windows (see SHARED), as
+  it would across the whole file. Its gain is how much better the shared
+  dictionary did than a fresh one on the same window.
+- The other engines compress each window cold. Their gain is how much better
+  they did on SPAN contiguous windows' worth of bytes than on the first of
+  those windows alone, scaled up (per doubling of context) to as much of the
+  file as the engine can use at once (see CONTEXT).
+
+Neither is exact, so treat the bound as a guide to the size of the error
+rather than a calibrated confidence interval.
+
+'''
+
+
+###############################################################################
+## Support Functions
+
+
+Estimate = collections.namedtuple('Estimate', 'ratio bound seconds')
+
+
+Z = 1.96 # two-sided 95% for a normal distribution
+
+
+def _lz(encode):
+    '''Make an engine which sends every window through one lz.encode.
+
+    The dictionary carries over from window to window, as it would while
+    compressing the whole file. Each call returns the bytes produced since the
+    last call.
+
+    '''
+    n = 0
+    @cr.coroutine
+    def counter():
+        nonlocal n
+        while True:
+            byt = yield
+            n += len(byt)
+    c = encode(counter(), quiet=True)
+    def engine(byt):
+        nonlocal n
+        n = 0
+        c.send(byt)
+        return n
+    return engine
+
+
+def _stdlib(name):
+    '''Make an engine from a stdlib compression module, or None if missing.
+
+    Windows are compressed independently of each other.
+
+    '''
+    try:
+        mod = __import__(name)
+    except ImportError:
+        return None
+    return lambda encode: lambda byt: len(mod.compress(byt))
+
+
+ENGINES = collections.OrderedDict(
+    (name, fn) for name, fn in [
+        ('lz', _lz),
+        ('zlib', _stdlib('zlib')),
+        ('bz2', _stdlib('bz2')),
+        ('lzma', _stdlib('lzma')),
+        ] if fn is not None)
+
+
+CONTEXT = { # bytes of history each cold engine can use at its defaults
+    'zlib': 32 * 1024,
+    'bz2': 900 * 1000,
+    'lzma': 8 * 1024 * 1024,
+    }
+
+
+SHARED = {'lz'} # engines which carry state from window to window
+
+BUDGET = 8 # sample about 1/BUDGET of the file
+MINSAMPLE = 16 * 1024
+MAXSAMPLE = 256 * 1024
+SPAN = 4 # windows per contiguous span when measuring context gain
+GAINS = 2 # windows on which context gain is measured
+
+
+def entropy(byt):
+    '''Order-0 entropy of bytes, in bits per byte.'''
+    if not byt:
+        return 0.0
+    total = len(byt)
+    return -sum(ct / total * math.log(ct / total, 2)
+                for ct in collections.Counter(byt).values())
+
+
+def offsets(size, windows=8):
+    '''Return the window width and offsets for sampling size bytes.
+
+    If the sample budget would cover the file, it is one window at offset 0.
+
+    '''
+    sample = min(MAXSAMPLE, max(MINSAMPLE, size // BUDGET))
+    if size <= sample:
+        return size, [0]
+    width = max(1, sample // windows)
+    stride = (size - width) // (windows - 1) if windows > 1 else 0
+    return width, [i * stride for i in range(windows)]
+
+
+def _summarize(ratios, seconds, sampled, size, gain=0.0):
+    '''Combine per-window ratios and total sampled seconds into an Estimate.
+
+    gain:
+        Optional. The context gain (see above), added to the bound.
+
+    '''
+    mean = sum(ratios) / len(ratios)
+    if sampled >= size or len(ratios) < 2:
+        bound = 0.0
+    else:
+        var = sum((r - mean) ** 2 for r in ratios) / (len(ratios) - 1)
+        bound = Z * math.sqrt(var / len(ratios)) + max(0.0, gain)
+    return Estimate(mean, bound, seconds * size / sampled)
+
+
+###############################################################################
+## Estimator
+
+
+def estimate(fd, size=None, windows=8, engines=None, encode=None):
+    '''Estimate each engine's compression ratio and time for file-like fd.
+
+    fd:
+        Must be opened with a binary mode that allows reading. If it can't
+        seek (like standard input) it is read into memory first.
+
+    size:
+        Optional. The number of bytes in fd. Found by seeking to the end by
+        default.
+
+    engines:
+        Optional. A sequence of names from ENGINES. All of them by default.
+
+    encode:
+        Optional. The lz encoder to measure. lz.encode by default.
+
+    ENGINES:
+        Maps engine names to factories. A factory takes the lz encoder and
+        returns a function which compresses one window (bytes) and returns its
+        compressed length. It is called once per estimate, and GAINS more
+        times for engines in SHARED.
+
+    Return a pair of an OrderedDict mapping engine names to Estimates, and an
+    Estimate for the order-0 entropy (as the ratio of entropy to 8 bits).
+
+    '''
+    if not fd.seekable():
+        fd = io.BytesIO(fd.read())
+        size = len(fd.getvalue())
+    if size is None:
+        size = fd.seek(0, io.SEEK_END)
+    if encode is None:
+        import lz
+        encode = lz.encode
+    names = list(ENGINES) if engines is None else list(engines)
+    if not size:
+        return (collections.OrderedDict((name, Estimate(0.0, 0.0, 0.0))
+                                        for name in names),
+                Estimate(0.0, 0.0, 0.0))
+    run = {name: ENGINES[name](encode) for name in names}
+    ratios = {name: [] for name in names}
+    seconds = {name: 0.0 for name in names}
+    bits = []
+    sampled = 0
+    width, starts = offsets(size, windows)
+    gainat = set(starts[::max(1, len(starts) // GAINS)][:GAINS])
+    alone = {name: [] for name in names}
+    more = {name: [] for name in names}
+    for start in starts:
+        fd.seek(start)
+        byt = fd.read(width)
+        sampled += len(byt)
+        bits.append(entropy(byt) / 8)
+        if start in gainat and len(starts) > 1:
+            fd.seek(start)
+            span = fd.read(SPAN * width)
+        else:
+            span = None
+        for name in names:
+            begun = time.time()
+            n = run[name](byt)
+            seconds[name] += time.time() - begun
+            ratios[name].append(n / len(byt))
+            if span is None:
+                continue
+            if name in SHARED:
+                alone[name].append(ENGINES[name](encode)(byt) / len(byt))
+                more[name].append(n / len(byt))
+            else:
+                alone[name].append(n / len(byt))
+                more[name].append(run[name](span) / len(span))
+    def gain(name):
+        if not alone[name]:
+            return 0.0
+        g = (sum(alone[name]) - sum(more[name])) / len(alone[name])
+        if name in CONTEXT:
+            reach = min(size, CONTEXT[name]) / width
+            g *= max(1.0, math.log(reach) / math.log(SPAN))
+        return g
+    return (collections.OrderedDict(
+                (name, _summarize(ratios[name], seconds[name], sampled, size,
+                                  gain(name)))
+                for name in names),
+            _summarize(bits, 0.0, sampled, size))
+
+
+def report(results, order0, printto):
+    '''Print the results of estimate as a table.'''
+    print('{:8} {:>7} {:>8} {:>10}'.format('engine', 'ratio', '+/-',
+                                            'seconds'), file=printto)
+    for name, e in results.items():
+        print('{:8} {:7.3f} {:8.3f} {:10.2f}'.format(name, e.ratio, e.bound,
+                                                     e.seconds), file=printto)
+    print('{:8} {:7.3f} {:8.3f} {:>10}'.format('order-0', order0.ratio,
+                                               order0.bound, '-'),
+          file=printto)
+
+
+###############################################################################
+## EOF
@@ -2,10 +2,15 @@
 
 
 # stdlib
+import io
 import os
 import sys
+import zlib
+import struct
+import hashlib
 import argparse
 import itertools
+import collections
 # local
 import cr
 import ints
@@ -30,21 +35,36 @@ some number of bytes to reference its known-prefix and exactly one new-byte.
 
 @cr.composedin(cr.trickle, None)
 @cr.coroutine
-def encode(nxt, quiet=False):
+def encode(nxt, quiet=False, state=None, checkpoint=None):
     '''Compress a stream of bytes according to LempelZiv.
 
     Consume bytes. Produce pointer-newbyte bytes.
 
+    state:
+        Optional. A State to resume from (see "loads"). Its table is used and
+        updated in place. The output continues the stream that produced the
+        state, less its partial block.
+
+    checkpoint:
+        Optional. A function which takes the final State when finished. It is
+        only called when the encoder is closed, not when it fails.
+
     When finished:
       Send buffer as a lone prefix. (If any leftover)
+      Call checkpoint with the final State. (If given and closed)
       Print a message to stderr. (Set quiet to True to disable)
 
     '''
-    table = {} # map known chunks to blockids
+    if state is None:
+        state = State({}, 0, b'')
+    table = state.table # map known chunks to blockids
+    pending = state.pending
+    closed = False
     try:
-        for blockid in itertools.count():
-            chunkm = bytearray()
-            chunk = None
+        for blockid in itertools.count(state.blockid):
+            chunkm = bytearray(pending)
+            chunk = bytes(chunkm) or None
+            pending = b''
             # accumulate an unfamiliar chunk
             while chunk in table or chunk is None:
                 chunkm.append((yield))
@@ -57,17 +77,194 @@ def encode(nxt, quiet=False):
             pointerb = ints.tobytes(pointer, length=ints.bytewidth(blockid))
             # send the block
             nxt.send(pointerb + newbyte)
+    except GeneratorExit:
+        closed = True
+        raise
     finally:
         if chunkm:
             pointer = table[chunk]
             pointerb = ints.tobytes(pointer, length=ints.bytewidth(blockid))
             # send partial block
             nxt.send(pointerb)
+        if closed and checkpoint is not None:
+            checkpoint(State(table, blockid, bytes(chunkm)))
         if not quiet:
             ct = blockid + (0.5 if chunkm else 0)
             print('lz.encoder: {} blocks done'.format(ct), file=sys.stderr)
 
 
+###############################################################################
+## Checkpoints
+
+
+class State(collections.namedtuple('State', 'table blockid pending')):
+    '''Encoder state between blocks.
+
+    table:
+        Maps known chunks to blockids.
+
+    blockid:
+        The id of the next block to send.
+
+    pending:
+        The bytes accumulated toward the next block (a known chunk, or empty).
+        The stream so far ends with these as a partial block.
+
+    '''
+    __slots__ = ()
+
+
+class Checkpoint(collections.namedtuple('Checkpoint',
+                                        'blockid consumed fingerprint '
+                                        'lengths')):
+    '''A serialized State (see "dumps").
+
+    blockid:
+        The id of the next block to send.
+
+    consumed:
+        The bytes of input which produced the State.
+
+    fingerprint:
+        Bytes identifying that input, as given to "dumps".
+
+    lengths:
+        The length of each block's chunk, in blockid order.
+
+    '''
+    __slots__ = ()
+
+
+MAGIC = b'pylzckpt'
+
+
+def consumed(state):
+    '''Count the bytes of input which produced state.'''
+    return sum(len(chunk) for chunk in state.table) + len(state.pending)
+
+
+def blocksize(count):
+    '''Count the bytes of the first count blocks of a stream.'''
+    n = 0
+    width, start = 0, 0
+    while start < count:
+        end = min(count, 256 ** width)
+        n += (end - start) * (width + 1)
+        width, start = width + 1, end
+    return n
+
+
+assert blocksize(0) == 0
+assert blocksize(1) == 1
+assert blocksize(2) == 3
+assert blocksize(256) == 1 + 255 * 2
+assert blocksize(257) == 1 + 255 * 2 + 3
+
+
+def dumps(state, fingerprint=b''):
+    '''Serialize state as bytes.
+
+    The chunks of the table are consecutive pieces of the input, so only their
+    lengths are stored. "loads" cuts them back out of the input. The pending
+    chunk is whatever input follows them.
+
+    fingerprint:
+        Optional. Bytes identifying the input (at most 255 of them).
+
+    '''
+    if list(state.table.values()) == list(range(state.blockid)):
+        lengths = list(map(len, state.table)) # built in blockid order
+    else:
+        lengths = [0] * state.blockid
+        for chunk, blockid in state.table.items():
+            lengths[blockid] = len(chunk)
+    packed = zlib.compress(struct.pack('>{}I'.format(len(lengths)), *lengths))
+    return (MAGIC + ints.tobytes(state.blockid, length=8) +
+            ints.tobytes(consumed(state), length=8) +
+            ints.tobytes(len(fingerprint), length=1) + fingerprint + packed)
+
+
+def header(byt):
+    '''Deserialize the Checkpoint from bytes made by "dumps".'''
+    i = len(MAGIC)
+    if byt[:i] != MAGIC or len(byt) < i + 17:
+        raise ValueError('not a pylz checkpoint')
+    count = ints.frombytes(byt[i:i + 8])
+    total = ints.frombytes(byt[i + 8:i + 16])
+    j = i + 17 + byt[i + 16]
+    try:
+        packed = zlib.decompress(byt[j:])
+    except zlib.error as e:
+        raise ValueError('bad block lengths: {}'.format(e))
+    if len(packed) != 4 * count:
+        raise ValueError('{} block lengths for {} blocks'.
+                         format(len(packed) // 4, count))
+    lengths = struct.unpack('>{}I'.format(count), packed)
+    return Checkpoint(count, total, byt[i + 17:j], lengths)
+
+
+def loads(byt, fd):
+    '''Deserialize a State from bytes made by "dumps".
+
+    fd:
+        The input which produced the State. Must be opened with a binary mode
+        that allows reading and seeking. Its first bytes are read back into the
+        table, leaving fd just past them.
+
+    Resuming from a loaded State continues the compressed stream exactly.
+
+    >>> import io
+    >>> saved = []
+    >>> head = _encoded(b'abracadabra abracadabr', checkpoint=saved.append)
+    >>> saved[0].pending
+    b'abr'
+    >>> src = io.BytesIO(b'abracadabra abracadabr')
+    >>> loads(dumps(saved[0], b'fp'), src) == saved[0]
+    True
+    >>> header(dumps(saved[0], b'fp'))[:3]
+    (11, 22, b'fp')
+    >>> tail = _encoded(b'a abracadabra', state=saved[0])
+    >>> (head[:blocksize(saved[0].blockid)] + tail ==
+    ...  _encoded(b'abracadabra abracadabra abracadabra'))
+    True
+    >>> loads(dumps(State({}, 0, b'')), io.BytesIO()) == State({}, 0, b'')
+    True
+
+    '''
+    ckpt = header(byt)
+    fd.seek(0)
+    data = fd.read(ckpt.consumed)
+    if len(data) != ckpt.consumed:
+        raise ValueError('input is {} bytes short'.
+                         format(ckpt.consumed - len(data)))
+    ends = list(itertools.accumulate(ckpt.lengths))
+    end = ends[-1] if ends else 0
+    if end > ckpt.consumed:
+        raise ValueError('blocks hold more than {} bytes'.
+                         format(ckpt.consumed))
+    table = dict(zip(map(data.__getitem__,
+                         map(slice, [0] + ends[:-1], ends)),
+                     range(ckpt.blockid)))
+    pending = data[end:]
+    if len(table) != ckpt.blockid or (pending and pending not in table):
+        raise ValueError('blocks do not match the input')
+    return State(table, ckpt.blockid, pending)
+
+
+def _encoded(byt, **kwargs):
+    '''Compress bytes with encode. Return the compressed bytes.'''
+    out = bytearray()
+    @cr.coroutine
+    def collect():
+        while True:
+            block = yield
+            out.extend(block)
+    c = encode(collect(), quiet=True, **kwargs)
+    c.send(byt)
+    c.close()
+    return bytes(out)
+
+
 ###############################################################################
 ## Decoder
 
@@ -159,6 +356,85 @@ def writeto(parser, args, suf):
     return sys.stdout.buffer if args.stdout else afile()
 
 
+def fingerprint(fd, offset):
+    '''Hash the first offset bytes of file-like fd.'''
+    h = hashlib.sha256()
+    fd.seek(0)
+    while offset > 0:
+        byt = fd.read(min(offset, io.DEFAULT_BUFFER_SIZE * 16))
+        if not byt:
+            break
+        h.update(byt)
+        offset -= len(byt)
+    return h.digest()
+
+
+def appendto(parser, args, suf):
+    '''Open the compressed file to extend. Return it and its saved State.
+
+    Without a checkpoint, start an empty compressed file and checkpoint. With
+    one, check that the source still begins with what was compressed, rebuild
+    the State from it and move both files to where the checkpoint left off.
+    That reads the old input once but compresses none of it again. Nothing is
+    truncated until the run finishes (see "savecheckpoint"), so an
+    interrupted run can simply be repeated.
+
+    '''
+    fn = args.file.name + suf
+    ckpt = fn + '.ckpt'
+    if not os.path.exists(ckpt):
+        if os.path.exists(fn):
+            parser.error('{} has no checkpoint; not appended'.format(fn))
+        with open(fn, mode='wb') as t:
+            savecheckpoint(t, State({}, 0, b''), fingerprint(args.file, 0))
+    if not os.path.exists(fn):
+        parser.error('{} is missing but {} exists; not appended'.
+                     format(fn, ckpt))
+    with open(ckpt, mode='rb') as f:
+        byt = f.read()
+    try:
+        saved = header(byt)
+    except ValueError as e:
+        parser.error('{}: {}'.format(ckpt, e))
+    if os.fstat(args.file.fileno()).st_size < saved.consumed:
+        parser.error('{} is shorter than when checkpointed; not appended'.
+                     format(args.file.name))
+    if fingerprint(args.file, saved.consumed) != saved.fingerprint:
+        parser.error('{} changed before the checkpointed offset; '
+                     'not appended'.format(args.file.name))
+    try:
+        state = loads(byt, args.file)
+    except ValueError as e:
+        parser.error('{} does not match {}: {}; not appended'.
+                     format(args.file.name, ckpt, e))
+    size = blocksize(state.blockid)
+    if os.stat(fn).st_size < size:
+        parser.error('{} is shorter than {} says; not appended'.
+                     format(fn, ckpt))
+    t = open(fn, mode='r+b')
+    t.seek(size)
+    return t, state
+
+
+def savecheckpoint(t, state, fingerprint):
+    '''Finish the compressed file t, then save state as its checkpoint.
+
+    t is cut off where it was last written and synced to disk first. The
+    checkpoint file is replaced only once fully written, so the checkpoint on
+    disk always describes blocks which are in t.
+
+    '''
+    t.truncate(t.tell())
+    t.flush()
+    os.fsync(t.fileno())
+    fn = t.name + '.ckpt'
+    with open(fn + '.tmp', mode='wb') as f:
+        f.write(dumps(state, fingerprint))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(fn + '.tmp', fn)
+
+
 DESC = '''Compress or decompress data with Lempel-Ziv. Given no file or given
 -, read from standard input and write to standard output. This program does
 not perform error correction (don't entrust your important data to it yet).'''
@@ -176,34 +452,71 @@ if __name__ == '__main__':
                     help='print status messages to standard error')
     ap.add_argument('-p', '--progress', action='store_true',
                     help='show file read progress')
+    ap.add_argument('-e', '--estimate', action='store_true',
+                    help='estimate compression ratio and time from samples '
+                         'of the file instead of compressing it')
+    ap.add_argument('-a', '--append', action='store_true',
+                    help='compress only what was added to the file since the '
+                         'last --append, extending its compressed file')
     ap.add_argument('file', nargs='?', type=argparse.FileType('rb'),
                     help='file to read')
     ns = ap.parse_args()
 
+    # estimate only reads
+    if ns.estimate and (ns.stdout or ns.decompress or ns.append or
+                        ns.progress):
+        ap.error('--estimate cannot be used with -c, -d, -a or -p')
+
     # read stdin implies: write stdout, no progress
     if ns.file is None:
         ns.stdout = True
         ns.progress = False
 
+    # append needs a named file to compress
+    if ns.append and (ns.stdout or ns.decompress):
+        ap.error('--append needs a file to compress to a file')
+
+    # estimate, then stop without writing anything
+    if ns.estimate:
+        import estimate
+        results, order0 = estimate.estimate(readfrom(ns), encode=encode)
+        estimate.report(results, order0, sys.stdout)
+        sys.exit(0)
+
     # get source and sink file objects
     s = readfrom(ns)
-    t = writeto(ap, ns, '.pylz')
+    if ns.append:
+        t, state = appendto(ap, ns, '.pylz')
+    else:
+        t = writeto(ap, ns, '.pylz')
 
     # build and launch the pipeline
     q = not ns.verbose
+    opts = {'quiet': q}
+    if ns.append:
+        saved = []
+        opts.update(state=state, checkpoint=saved.append)
     trans = decode if ns.decompress else encode
     if ns.progress:
         # wrap the translation with a progress bar
         proc = (lambda *args, **kwargs:
-                progress.cr(trans(*args, **kwargs), os.stat(s.name).st_size,
+                progress.cr(trans(*args, **kwargs),
+                            os.stat(s.name).st_size - s.tell(),
                             timeout=1, callback=progressline, count=len))
     else:
         # do a plain translation
         proc = trans
     try:
-        cr.filesource(s, proc(cr.filesink(t, quiet=q), quiet=q), quiet=q)
+        cr.filesource(s, proc(cr.filesink(t, quiet=q), **opts), quiet=q)
     except cr.UnsentError:
         print('lz.py: error: unsent bytes, probably corrupt')
+        sys.exit(1)
+
+    # save the encoder state once the compressed file is complete
+    if ns.append:
+        offset = consumed(saved[0])
+        savecheckpoint(t, saved[0], fingerprint(s, offset))
+        t.close()
 
 
 ###############################################################################
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+
+# stdlib
+import os
+import sys
+import socket
+import argparse
+import tempfile
+import threading
+# local
+import ints
+
+
+'''Thin client for the pylz daemon (see serve.py), and its frame protocol.
+
+Every frame is a one-byte tag, a four-byte big-endian payload length and the
+payload. A job is one start frame, any number of data frames and an end frame:
+
+    client: COMPRESS or DECOMPRESS, DATA..., END
+    server: DATA..., then END, or ERROR with a message
+
+A connection may carry any number of jobs, one after another. The server sends
+output while input is still arriving, so a client must read and write at the
+same time.
+
+'''
+
+
+###############################################################################
+## Protocol
+
+
+COMPRESS = b'C'
+DECOMPRESS = b'D'
+DATA = b'.'
+END = b'$'
+ERROR = b'!'
+
+CHUNK = 64 * 1024 # payload bytes per data frame
+
+
+class ProtocolError(Exception):
+    '''Exception for when a peer sends an unexpected frame.'''
+    pass
+
+
+def frame(tag, payload=b''):
+    '''Make the bytes of one frame.'''
+    return tag + ints.tobytes(len(payload), length=4) + payload
+
+
+def readexactly(sock, n):
+    '''Receive exactly n bytes from sock. Raise EOFError if it closes first.'''
+    buf = bytearray()
+    while len(buf) < n:
+        byt = sock.recv(n - len(buf))
+        if not byt:
+            raise EOFError('connection closed after {} of {} bytes'.
+                           format(len(buf), n))
+        buf += byt
+    return bytes(buf)
+
+
+def readframe(sock):
+    '''Receive one frame from sock. Return its tag and payload.'''
+    tag = readexactly(sock, 1)
+    n = ints.frombytes(readexactly(sock, 4))
+    return tag, readexactly(sock, n)
+
+
+###############################################################################
+## Addresses
+
+
+DEFAULT = os.path.join(tempfile.gettempdir(),
+                       'pylz-{}.sock'.format(os.getuid()))
+
+
+def addargs(ap):
+    '''Add the options which choose the daemon's address to ArgumentParser ap.'''
+    ap.add_argument('-u', '--unix', metavar='PATH', default=DEFAULT,
+                    help='unix socket path (default: %(default)s)')
+    ap.add_argument('-t', '--port', type=int,
+                    help='use localhost TCP on this port instead')
+
+
+def address(args):
+    '''Return the socket family and address chosen by addargs' options.'''
+    if args.port is not None:
+        return socket.AF_INET, ('127.0.0.1', args.port)
+    return socket.AF_UNIX, args.unix
+
+
+###############################################################################
+## Client
+
+
+def request(sock, op, fd, out, chunk=CHUNK):
+    '''Run one job on the daemon connected to sock.
+
+    op:
+        COMPRESS or DECOMPRESS.
+
+    fd:
+        Must be opened with a binary mode that allows reading. It is sent
+        from another thread while the output is received.
+
+    out:
+        Must be opened with a binary mode that allows writing.
+
+    Return None if the job finished, or the daemon's error message.
+
+    '''
+    def send():
+        try:
+            sock.sendall(frame(op))
+            byt = fd.read(chunk)
+            while byt:
+                sock.sendall(frame(DATA, byt))
+                byt = fd.read(chunk)
+            sock.sendall(frame(END))
+        except OSError:
+            pass # the daemon hung up; its reason arrives as an error frame
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    try:
+        while True:
+            tag, payload = readframe(sock)
+            if tag == DATA:
+                out.write(payload)
+            elif tag == END:
+                sender.join()
+                return None
+            elif tag == ERROR:
+                return payload.decode('utf-8', 'replace')
+            else:
+                raise ProtocolError('unexpected frame {!r}'.format(tag))
+    except EOFError as e:
+        return str(e)
+
+
+###############################################################################
+## Main
+
+
+DESC = '''Compress or decompress data with a running pylz daemon (see
+serve.py), writing to standard output like "lz.py -c". Given no file or given
+-, read from standard input.'''
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    ap = argparse.ArgumentParser(description=DESC)
+    ap.add_argument('-c', '--stdout', action='store_true',
+                    help='write to standard output (always on)')
+    ap.add_argument('-d', '--decompress', action='store_true',
+                    help='decompress data instead')
+    ap.add_argument('file', nargs='?', type=argparse.FileType('rb'),
+                    help='file to read')
+    addargs(ap)
+    ns = ap.parse_args()
+
+    # connect and run the job
+    family, addr = address(ns)
+    op = DECOMPRESS if ns.decompress else COMPRESS
+    try:
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.connect(addr)
+            err = request(sock, op, ns.file or sys.stdin.buffer,
+                          sys.stdout.buffer)
+    except OSError as e:
+        err = 'cannot reach daemon at {}: {}'.format(addr, e.strerror or e)
+    sys.stdout.flush()
+    if err is not None:
+        print('pylzc.py: error: {}'.format(err), file=sys.stderr)
+        sys.exit(1)
+
+
+###############################################################################
+## EOF
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+
+# stdlib
+import os
+import re
+import sys
+import time
+import array
+import signal
+import select
+import socket
+import struct
+import argparse
+import collections
+# local
+import cr
+import lz
+import pylzc
+from pylzc import COMPRESS, DECOMPRESS, DATA, END, ERROR, CHUNK
+
+
+'''Long-running pylz daemon with a pool of pre-forked workers.
+
+Starting lz.py costs an interpreter and its imports, which is often more
+than the compression itself for small jobs. The daemon pays that once: it
+forks workers with lz.encode and lz.decode already loaded, and hands them one
+job at a time. A worker that dies is replaced.
+
+See pylzc.py for the frame protocol and a client.
+
+- The parent accepts every connection and holds it while it is idle. When a
+  job arrives it passes the connection to a free worker, which runs that one
+  job and passes it back. Idle connections don't hold a worker, and are
+  closed after IDLE seconds.
+- Each client (a uid on a unix socket) may have at most a limited number of
+  jobs running at once, all the workers by default. Its other jobs wait in
+  the parent, behind other clients' jobs, without holding a worker. Over TCP
+  every client is 127.0.0.1, so the limit applies to all of them together.
+- Input and output are streamed in frames; a job never holds its whole
+  payload in memory. A job whose client sends nothing for TIMEOUT seconds is
+  dropped.
+
+'''
+
+
+###############################################################################
+## Support Functions
+
+
+IDLE = 60 # seconds a connection may wait between jobs
+TIMEOUT = 60 # seconds a running job may wait for its client
+
+
+def clientof(conn, peer):
+    '''Name the client on connection conn for per-client limits.
+
+    On a unix socket this is the peer's uid. Over TCP it is the peer's address,
+    which for this localhost-only daemon is the same for every client.
+
+    '''
+    if conn.family == socket.AF_UNIX:
+        if hasattr(socket, 'SO_PEERCRED'):
+            cred = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                   struct.calcsize('3i'))
+            pid, uid, gid = struct.unpack('3i', cred)
+            return 'uid-{}'.format(uid)
+        return 'unix'
+    return 'addr-' + re.sub(r'[^0-9A-Za-z.]', '_', peer[0])
+
+
+def sendconn(control, msg, conn):
+    '''Send msg (bytes) and a copy of socket conn over unix socket control.'''
+    fds = array.array('i', [conn.fileno()])
+    control.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def recvconn(control):
+    '''Receive what sendconn sent. Raise EOFError if control is closed.'''
+    fds = array.array('i')
+    msg, anc, flags, addr = control.recvmsg(256,
+                                            socket.CMSG_LEN(fds.itemsize))
+    if not msg:
+        raise EOFError('control socket closed')
+    for level, kind, data in anc:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:fds.itemsize])
+    return msg, socket.socket(fileno=fds[0])
+
+
+@cr.coroutine
+def socksink(sock, errors, chunk=CHUNK):
+    '''Coroutine. Consume bytes objects. Send them to sock as data frames.
+
+    Bytes are gathered until there are at least chunk of them.
+
+    errors:
+        A list. An OSError from sock is appended to it instead of raised, and
+        everything after it is dropped.
+
+    When finished:
+        Send whatever is left as a last data frame.
+
+    '''
+    buf = bytearray()
+    def send():
+        if not errors:
+            try:
+                sock.sendall(pylzc.frame(DATA, bytes(buf)))
+            except OSError as e:
+                errors.append(e)
+        del buf[:]
+    try:
+        while True:
+            byt = yield
+            buf += byt
+            if len(buf) >= chunk:
+                send()
+    finally:
+        if buf:
+            send()
+
+
+###############################################################################
+## Worker
+
+
+def job(conn):
+    '''Run the next job from conn.
+
+    Return False if the client hung up instead of starting one.
+
+    '''
+    try:
+        op, payload = pylzc.readframe(conn)
+    except EOFError:
+        return False
+    if op not in (COMPRESS, DECOMPRESS):
+        raise pylzc.ProtocolError('unexpected frame {!r}'.format(op))
+    trans = lz.encode if op == COMPRESS else lz.decode
+    errors = []
+    sink = socksink(conn, errors)
+    pipe = trans(sink, quiet=True)
+    err = None
+    try:
+        while True:
+            tag, payload = pylzc.readframe(conn)
+            if tag == END:
+                break
+            if tag != DATA:
+                raise pylzc.ProtocolError('unexpected frame {!r}'.
+                                          format(tag))
+            if err is None:
+                try:
+                    pipe.send(payload)
+                except Exception as e:
+                    err = e # keep reading until END to stay in step
+        if err is None:
+            try:
+                pipe.close()
+                sink.close()
+            except Exception as e:
+                err = e
+    finally:
+        # on the way out of a failed job, the client may be gone
+        for c in (pipe, sink):
+            try:
+                c.close()
+            except Exception:
+                pass
+    if errors:
+        raise errors[0]
+    if err is None:
+        conn.sendall(pylzc.frame(END))
+    elif isinstance(err, cr.UnsentError):
+        conn.sendall(pylzc.frame(ERROR, b'unsent bytes, probably corrupt'))
+    else:
+        msg = '{}: {}'.format(type(err).__name__, err)
+        conn.sendall(pylzc.frame(ERROR, msg.encode('utf-8')))
+    return True
+
+
+def work(control, quiet=False):
+    '''Run jobs on the connections the parent sends over control, forever.
+
+    After each job, tell the parent whether to keep the connection (b'k') or
+    drop it (b'x').
+
+    '''
+    while True:
+        try:
+            client, conn = recvconn(control)
+        except EOFError:
+            return
+        keep = False
+        with conn:
+            conn.settimeout(TIMEOUT)
+            try:
+                keep = job(conn)
+            except (OSError, EOFError, pylzc.ProtocolError) as e:
+                if not quiet:
+                    print('serve.worker {}: {}: {}'.format(
+                              os.getpid(), client.decode(), e),
+                          file=sys.stderr)
+        control.sendall(b'k' if keep else b'x')
+
+
+###############################################################################
+## Server
+
+
+def serve(listener, workers=4, limit=None, quiet=False):
+    '''Serve the bound, listening socket listener with forked workers.
+
+    workers:
+        The number of worker processes. One job runs in each at a time.
+
+    limit:
+        Optional. The most jobs that one client may have running at once.
+        Its others wait. All the workers by default.
+
+    Replace workers which exit until interrupted (SIGINT or SIGTERM), then
+    stop them all.
+
+    '''
+    if limit is None:
+        limit = workers
+    pool = {}                           # control socket -> worker pid
+    free = collections.deque()          # control sockets of idle workers
+    busy = {}                           # control socket -> (client, conn)
+    running = collections.Counter()     # client -> jobs running
+    waiting = collections.deque()       # (client, conn) with a job to run
+    parked = {}                         # idle conn -> (client, since)
+
+    def spawn():
+        ours, theirs = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                listener.close()
+                ours.close()
+                for s in list(pool) + list(parked):
+                    s.close()
+                for client, conn in list(busy.values()) + list(waiting):
+                    conn.close()
+                work(theirs, quiet)
+            finally:
+                os._exit(1)
+        theirs.close()
+        pool[ours] = pid
+        free.append(ours)
+
+    def retire(control):
+        pid = pool.pop(control)
+        control.close()
+        if control in free:
+            free.remove(control)
+        if control in busy:
+            client, conn = busy.pop(control)
+            running[client] -= 1
+            conn.close()
+        os.waitpid(pid, 0)
+        if not quiet:
+            print('serve: worker {} exited; replacing'.format(pid),
+                  file=sys.stderr)
+        spawn()
+
+    def dispatch():
+        for entry in list(waiting):
+            if not free:
+                return
+            client, conn = entry
+            if running[client] >= limit:
+                continue
+            waiting.remove(entry)
+            control = free.popleft()
+            try:
+                sendconn(control, client.encode(), conn)
+            except OSError:
+                waiting.appendleft(entry)
+                continue # the worker is gone; retire will notice
+            busy[control] = entry
+            running[client] += 1
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for _ in range(workers):
+            spawn()
+        if not quiet:
+            print('serve: {} workers on {}'.format(workers,
+                                                   listener.getsockname()),
+                  file=sys.stderr)
+        while True:
+            dispatch()
+            now = time.time()
+            wait = min([since + IDLE - now
+                        for client, since in parked.values()] or [IDLE])
+            ready, _, _ = select.select([listener] + list(pool) +
+                                        list(parked), [], [], max(0, wait))
+            now = time.time()
+            for s in ready:
+                if s is listener:
+                    conn, peer = listener.accept()
+                    parked[conn] = (clientof(conn, peer), now)
+                elif s in pool:
+                    msg = s.recv(1)
+                    if not msg:
+                        retire(s)
+                        continue
+                    client, conn = busy.pop(s)
+                    running[client] -= 1
+                    free.append(s)
+                    if msg == b'k':
+                        parked[conn] = (client, now)
+                    else:
+                        conn.close()
+                else:
+                    client, since = parked.pop(s)
+                    waiting.append((client, s))
+            for conn, (client, since) in list(parked.items()):
+                if now - since >= IDLE:
+                    del parked[conn]
+                    conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for control, pid in pool.items():
+            control.close()
+            os.kill(pid, signal.SIGTERM)
+        for pid in pool.values():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass # already reaped
+        if not quiet:
+            print('serve: stopped', file=sys.stderr)
+
+
+def listen(family, addr, backlog=64):
+    '''Return a socket bound to addr and listening.
+
+    A unix socket path left behind by a daemon which is no longer running is
+    replaced. One which still answers is an error.
+
+    '''
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        with socket.socket(family, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(addr)
+            except OSError:
+                os.unlink(addr)
+            else:
+                sock.close()
+                raise OSError('a daemon is already serving {}'.format(addr))
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen(backlog)
+    return sock
+
+
+###############################################################################
+## Main
+
+
+DESC = '''Serve pylz compression and decompression to pylzc.py clients from a
+pool of pre-forked workers, on a unix socket or a localhost TCP port.'''
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    ap = argparse.ArgumentParser(description=DESC)
+    ap.add_argument('-w', '--workers', type=int, default=4,
+                    help='worker processes (default: %(default)s)')
+    ap.add_argument('-l', '--limit', type=int,
+                    help='most jobs one client may run at once; its '
+                         'others wait (default: all workers)')
+    ap.add_argument('-v', '--verbose', action='store_true',
+                    help='print status messages to standard error')
+    pylzc.addargs(ap)
+    ns = ap.parse_args()
+    if ns.workers < 1 or (ns.limit is not None and ns.limit < 1):
+        ap.error('--workers and --limit must be at least 1')
+
+    # bind, then serve until interrupted
+    family, addr = pylzc.address(ns)
+    try:
+        listener = listen(family, addr)
+    except OSError as e:
+        ap.error(str(e))
+    try:
+        serve(listener, ns.workers, ns.limit, quiet=not ns.verbose)
+    finally:
+        listener.close()
+        if family == socket.AF_UNIX:
+            os.unlink(addr)
+
+
+###############################################################################
+## EOF